@@ -1,17 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import asyncio
+import functools
+import time
+import weakref
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+
 import pyvisa
 import numpy as np
 
+# Pulse sample channel readings that mean the current is logged
+_CURR_SAMPLE = frozenset(('CURR', 'CURRENT'))
+
 
 class Device:
-    def __init__(self, visa_addr='GPIB0::4::INSTR'):
+    def __init__(self, visa_addr='GPIB0::4::INSTR', cache_ttl=0.0):
         self._address = str(visa_addr)
         self._visa_driver = pyvisa.ResourceManager()
         self._bus = self._visa_driver.open_resource(self._address)
         self._command = Command(self._bus)
+        self._cache = QueryCache.for_bus(self._bus)
+        self._cache.ttl = cache_ttl
         self._bus.read_termination = '\n'
         self._bus.write_termination = '\n'
+        # Large reads so sample arrays arrive in a single low-level read
+        self._bus.chunk_size = 1 << 20
 
         # Device class shortcuts
         self.display = Display(self._bus)
@@ -22,42 +36,133 @@ class Device:
         self.relay = RelayControl(self._bus)
 
     def write(self, command):
-        self._bus.write(command)
+        self._command.write(command)
 
+    # Raw reads go past Command, so send any batched writes first
     def read(self):
+        self._command.flush()
         self._bus.read()
 
     def query(self, command):
-        return self._bus.query(command)
+        return self._command.read(command)
 
     def read_raw(self):
+        self._command.flush()
         return self._bus.read_raw()
 
     def disconnect(self):
         self._bus.close()
 
+    # with Device(...) as dev: closes the VISA session on exit
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
+
+    # Seconds a setting query result is reused (0 disables caching)
+    @property
+    def cache_ttl(self):
+        return self._cache.ttl
+
+    @cache_ttl.setter
+    def cache_ttl(self, seconds):
+        self._cache.ttl = seconds
+
+    # Drop all cached setting values (e.g. after front panel changes)
+    def invalidate_cache(self):
+        self._cache.clear()
+
+    # Send the setting writes inside a with block as one compound message
+    def batched(self):
+        return self._command.batched()
+
+    # Bypass the query cache inside a with block
+    @contextmanager
+    def no_cache(self):
+        enabled = self._cache.enabled
+        self._cache.enabled = False
+        try:
+            yield self
+        finally:
+            self._cache.enabled = enabled
+
     def all_on(self):
-        write = ':CONF:A:COMM:OUTP:ONOF ON'
-        self._command.write(write)
-        write = ':OUT:A ON'
-        self._command.write(write)
-        write = ':CONF:A:COMM:OUTP:ONOF OFF'
+        write = ':CONF:A:COMM:OUTP:ONOF ON;:OUT:A ON;:CONF:A:COMM:OUTP:ONOF OFF'
         self._command.write(write)
 
     def all_off(self):
-        write = ':CONF:A:COMM:OUTP:ONOF ON'
-        self._command.write(write)
-        write = ':OUT:A OFF'
-        self._command.write(write)
-        write = ':CONF:A:COMM:OUTP:ONOF OFF'
+        write = ':CONF:A:COMM:OUTP:ONOF ON;:OUT:A OFF;:CONF:A:COMM:OUTP:ONOF OFF'
         self._command.write(write)
 
+    # Sample channel A and B in the same pulse acquisition. Both channels
+    # are armed together and each array is fetched as soon as its reading
+    # is available, so the sampling times overlap instead of adding up.
+    # Results go to cha.log.log_data and chb.log.log_data.
+    # timeout (ms) defaults to the longer of the two channel timeouts
+    def acquire_both(self, binary=True, timeout=None):
+        logs = (self.cha.log, self.chb.log)
+        if timeout is None:
+            timeout = max(log._sample_timeout() for log in logs)
+        com = logs[0].com
+        for log in logs:
+            log.log_data.clear()
+        # Clear the error queue and measurement event register
+        self.status.clear_error_queue()
+        self.status.get_meas_event_reg()
+        # Save current measurement enable register
+        enable_reg = int(self.status.meas_enable_reg())
+        try:
+            # Enable measurement events of both channels and SRQ
+            self.status.meas_enable_reg(
+                    logs[0]._event_mask | logs[1]._event_mask)
+            com.sre(1)
+            com.wait()
+            self._command.write(';'.join(log._pulse_start for log in logs))
+            self._command.flush()
+
+            # Reading the event register clears it, so the bits are
+            # collected until every channel has its reading or a trigger
+            # timeout
+            deadline = time.monotonic() + timeout / 1000
+            events = 0
+            pending = list(logs)
+            while pending:
+                remaining = int((deadline - time.monotonic()) * 1000)
+                if remaining <= 0:
+                    break
+                self._bus.wait_for_srq(remaining)
+                events |= int(self.status.get_meas_event_reg())
+                for log in list(pending):
+                    if events & (log._reading_avail | log._trigger_timeout):
+                        log._store_sample(events, binary)
+                        pending.remove(log)
+            for log in pending:
+                log._store_sample(events, binary)
+        finally:
+            com.sre(0)
+            # Restore measurement enable register
+            self.status.meas_enable_reg(enable_reg)
+
 
 class Common:
     def __init__(self, bus):
         self._bus = bus
         self._validate = ValidateRegister()
         self._command = Command(self._bus)
+        # Accessors bound once per setting
+        self._get_ese = self._command.make_getter('*ESE?')
+        self._set_ese = self._command.make_setter(
+                '*ESE?', '*ESE', self._validate.register_8)
+        self._get_rcl = self._command.make_getter('*RCL?')
+        self._set_rcl = self._command.make_setter(
+                '*RCL?', '*RCL', self._validate.preset)
+        self._get_sav = self._command.make_getter('*SAV?')
+        self._set_sav = self._command.make_setter(
+                '*SAV?', '*SAV', self._validate.preset)
+        self._get_sre = self._command.make_getter('*SRE?')
+        self._set_sre = self._command.make_setter(
+                '*SRE?', '*SRE', self._validate.register_8)
 
     # Clears event registers and errors
     def cls(self):
@@ -67,10 +172,9 @@ class Common:
     # Read standard event enable register (no param)
     # Write with param
     def ese(self, reg_value=None):
-        query = '*ESE?'
-        write = '*ESE'
-        return self._command.read_write(
-                query, write, self._validate.register_8, reg_value)
+        if reg_value is None:
+            return self._get_ese()
+        return self._set_ese(reg_value)
 
     # Read and clear standard event enable register
     def esr(self):
@@ -87,15 +191,18 @@ class Common:
     def opc(self, reg_value=None):
         query = '*OPC?'
         write = '*OPC'
-        return self._command.read_write(
-                query, write, reg_value)
+        # *OPC? blocks until pending operations finish, never serve it cached
+        if reg_value is None:
+            return self._command.read(query)
+        # *OPC takes no parameter; any reg_value sets the bit
+        return self._command.write(write)
 
     # Returns the power supply to the saved setup (0...9)
     def rcl(self, preset_value=None):
-        query = '*RCL?'
-        write = '*RCL'
-        return self._command.read_write(
-                query, write, self._validate.preset, preset_value)
+        if preset_value is None:
+            return self._get_rcl()
+        self._set_rcl(preset_value)
+        self._command.invalidate_cache()
 
     # Returns the power supply to the *RST default conditions
     def rst(self):
@@ -105,17 +212,15 @@ class Common:
 
     # Saves the present setup (1..9)
     def sav(self, preset_value=None):
-        query = '*SAV?'
-        write = '*SAV'
-        return self._command.read_write(
-                query, write, self._validate.preset, preset_value)
+        if preset_value is None:
+            return self._get_sav()
+        return self._set_sav(preset_value)
 
     # Programs the service request enable register
     def sre(self, reg_value=None):
-        query = '*SRE?'
-        write = '*SRE'
-        return self._command.read_write(
-                query, write, self._validate.register_8, reg_value)
+        if reg_value is None:
+            return self._get_sre()
+        return self._set_sre(reg_value)
 
     # Reads the status byte register
     def stb(self):
@@ -143,19 +248,72 @@ class Channel:
         self._bus = bus
         self._validate = ValidateChannel()
         self._channel = self._validate.channel(channel)
-        if isinstance(self._channel, (ValueError, TypeError)):
-            raise self._channel
         self._command = Command(self._bus)
-        self.values = {}
-        self.values = {
-                'output': self.output(),
-                'voltage': self.voltage(),
-                'current': self.current(),
-                'current_range': self.current_range(),
-                'measurement_interval': self.measurement_interval(),
-                'average_count': self.average_count(),
-                'impedance': self.impedance(),
-                'output_bandwidth': self.output_bandwidth()}
+        ch = self._channel
+        self._q_output = f':OUTP:{ch}:STAT?'
+        self._w_output = f':OUT:{ch}'
+        self._q_voltage = f':SOUR:{ch}:VOLT?'
+        self._w_voltage = f':SOUR:{ch}:VOLT'
+        self._q_current = f':SOUR:{ch}:CURR?'
+        self._w_current = f':SOUR:{ch}:CURR:LIM'
+        self._q_current_range = f':SENS:{ch}:CURR:RANG?'
+        self._w_current_range = f':SENS:{ch}:CURR:RANG'
+        self._q_measurement_interval = f':SENS:{ch}:MEAS:INT?'
+        self._w_measurement_interval = f':SENS:{ch}:MEAS:INT'
+        self._q_average_count = f':SENS:{ch}:AVER:COUN?'
+        self._w_average_count = f':SENS:{ch}:AVER:COUN'
+        self._q_output_bandwidth = f':OUTP:{ch}:BAND?'
+        self._w_output_bandwidth = f':OUTP:{ch}:BAND'
+        self._q_impedance = f':OUTP:{ch}:IMP?'
+        self._w_impedance = f':OUTP:{ch}:IMP'
+        self.values = LazyValues(self._command, {
+                'output': self._q_output,
+                'voltage': self._q_voltage,
+                'current': self._q_current,
+                'current_range': self._q_current_range,
+                'measurement_interval': self._q_measurement_interval,
+                'average_count': self._q_average_count,
+                'impedance': self._q_impedance,
+                'output_bandwidth': self._q_output_bandwidth})
+        # Accessors bound once per setting
+        self._get_output = self._command.make_getter(self._q_output)
+        self._set_output = self._command.make_setter(
+                self._q_output, self._w_output, self._validate.on_off,
+                self.values, 'output')
+        self._get_voltage = self._command.make_getter(self._q_voltage)
+        self._set_voltage = self._command.make_setter(
+                self._q_voltage, self._w_voltage, self._validate.voltage,
+                self.values, 'voltage')
+        self._get_current = self._command.make_getter(self._q_current)
+        self._set_current = self._command.make_setter(
+                self._q_current, self._w_current, self._validate.current,
+                self.values, 'current')
+        self._get_current_range = self._command.make_getter(
+                self._q_current_range)
+        self._set_current_range = self._command.make_setter(
+                self._q_current_range, self._w_current_range,
+                self._validate.current_range, self.values, 'current_range')
+        self._get_measurement_interval = self._command.make_getter(
+                self._q_measurement_interval)
+        self._set_measurement_interval = self._command.make_setter(
+                self._q_measurement_interval, self._w_measurement_interval,
+                self._validate.measurement_interval, self.values,
+                'measurement_interval')
+        self._get_average_count = self._command.make_getter(
+                self._q_average_count)
+        self._set_average_count = self._command.make_setter(
+                self._q_average_count, self._w_average_count,
+                self._validate.average_count, self.values, 'average_count')
+        self._get_output_bandwidth = self._command.make_getter(
+                self._q_output_bandwidth)
+        self._set_output_bandwidth = self._command.make_setter(
+                self._q_output_bandwidth, self._w_output_bandwidth,
+                self._validate.output_bandwidth, self.values,
+                'output_bandwidth')
+        self._get_impedance = self._command.make_getter(self._q_impedance)
+        self._set_impedance = self._command.make_setter(
+                self._q_impedance, self._w_impedance, self._validate.impedance,
+                self.values, 'impedance')
 
         # Channel class shortcuts
         self.meas = Measure(self._bus, self._channel)
@@ -164,11 +322,9 @@ class Channel:
         self.prot = Protection(self._bus, self._channel)
 
     def output(self, set_input_on_off=None):
-        query = ':OUTP:' + self._channel + ':STAT?'
-        write = ':OUT:' + self._channel
-        return self._command.read_write(
-                query, write, self._validate.on_off,
-                set_input_on_off, self.values, 'output')
+        if set_input_on_off is None:
+            return self._get_output()
+        return self._set_output(set_input_on_off)
 
     def on(self):
         self.output('ON')
@@ -178,60 +334,46 @@ class Channel:
 
     # resolution: 1mV
     def voltage(self, set_voltage=None):
-        query = ':SOUR:' + self._channel + ':VOLT?'
-        write = ':SOUR:' + self._channel + ':VOLT'
-        return self._command.read_write(
-                query, write, self._validate.voltage,
-                set_voltage, self.values, 'voltage')
+        if set_voltage is None:
+            return self._get_voltage()
+        return self._set_voltage(set_voltage)
 
     # Sets current limit in Amps (max. 2.5A on voltages above 5V)
     # resolution: 1mA
     def current(self, set_current=None):
-        query = ':SOUR:' + self._channel + ':CURR?'
-        write = ':SOUR:' + self._channel + ':CURR:LIM'
-        return self._command.read_write(
-                query, write, self._validate.current,
-                set_current, self.values, 'current')
+        if set_current is None:
+            return self._get_current()
+        return self._set_current(set_current)
 
     # Selects expected current measurement range
     def current_range(self, set_current_range=None):
-        query = ':SENS:' + self._channel + ':CURR:RANG?'
-        write = ':SENS:' + self._channel + ':CURR:RANG'
-        return self._command.read_write(
-                query, write, self._validate.current_range,
-                set_current_range, self.values, 'current_range')
+        if set_current_range is None:
+            return self._get_current_range()
+        return self._set_current_range(set_current_range)
 
     # Sets the measurement interval for voltage and current
     def measurement_interval(self, set_measurement_interval=None):
-        query = ':SENS:' + self._channel + ':MEAS:INT?'
-        write = ':SENS:' + self._channel + ':MEAS:INT'
-        return self._command.read_write(
-                query, write, self._validate.measurement_interval,
-                set_measurement_interval, self.values, 'measurement_interval')
+        if set_measurement_interval is None:
+            return self._get_measurement_interval()
+        return self._set_measurement_interval(set_measurement_interval)
 
     # Sets the measure average count
     def average_count(self, set_average_count=None):
-        query = ':SENS:' + self._channel + ':AVER:COUN?'
-        write = ':SENS:' + self._channel + ':AVER:COUN'
-        return self._command.read_write(
-                query, write, self._validate.average_count,
-                set_average_count, self.values, 'average_count')
+        if set_average_count is None:
+            return self._get_average_count()
+        return self._set_average_count(set_average_count)
 
     def output_bandwidth(self, set_output_bandwidth=None):
-        query = ':OUTP:' + self._channel + ':BAND?'
-        write = ':OUTP:' + self._channel + ':BAND'
-        return self._command.read_write(
-                query, write, self._validate.output_bandwidth,
-                set_output_bandwidth, self.values, 'output_bandwidth')
+        if set_output_bandwidth is None:
+            return self._get_output_bandwidth()
+        return self._set_output_bandwidth(set_output_bandwidth)
 
     # Specifies the output impedance to apply. 0 Ohms to
     # 1 Ohms in 10 mOhm steps
     def impedance(self, set_impedance=None):
-        query = ':OUTP:' + self._channel + ':IMP?'
-        write = ':OUTP:' + self._channel + ':IMP'
-        return self._command.read_write(
-                query, write, self._validate.impedance,
-                set_impedance, self.values, 'impedance')
+        if set_impedance is None:
+            return self._get_impedance()
+        return self._set_impedance(set_impedance)
 
 
 class Display:
@@ -239,17 +381,27 @@ class Display:
         self._bus = bus
         self._validate = ValidateDisplay()
         self._command = Command(self._bus)
-        self.values = {}
-        self.values = {
-                'display_on': self.enable(),
-                'display_channel': self.channel()}
+        self._q_enable = ':DISP:ENAB?'
+        self._w_enable = ':DISP:ENAB'
+        self._q_channel = ':DISP:CHAN?'
+        self._w_channel = ':DISP:CHAN'
+        self.values = LazyValues(self._command, {
+                'display_on': self._q_enable,
+                'display_channel': self._q_channel})
+        # Accessors bound once per setting
+        self._get_enable = self._command.make_getter(self._q_enable)
+        self._set_enable = self._command.make_setter(
+                self._q_enable, self._w_enable, self._validate.on_off,
+                self.values, 'display_on')
+        self._get_channel = self._command.make_getter(self._q_channel)
+        self._set_channel = self._command.make_setter(
+                self._q_channel, self._w_channel, self._validate.channel,
+                self.values, 'display_channel')
 
     def enable(self, set_enable_on_off=None):
-        query = ':DISP:ENAB?'
-        write = ':DISP:ENAB'
-        return self._command.read_write(
-            query, write, self._validate.on_off,
-            set_enable_on_off, self.values, 'display_on')
+        if set_enable_on_off is None:
+            return self._get_enable()
+        return self._set_enable(set_enable_on_off)
 
     def on(self):
         self.enable('ON')
@@ -259,11 +411,9 @@ class Display:
 
     # Changes the active display channel
     def channel(self, set_channel=None):
-        query = ':DISP:CHAN?'
-        write = ':DISP:CHAN'
-        return self._command.read_write(
-            query, write, self._validate.channel,
-            set_channel, self.values, 'display_channel')
+        if set_channel is None:
+            return self._get_channel()
+        return self._set_channel(set_channel)
 
 
 class Format:
@@ -271,27 +421,35 @@ class Format:
         self._bus = bus
         self._validate = ValidateFormat()
         self._command = Command(self._bus)
-        self.values = {}
-        self.values = {
-                'data_format': self.data(),
-                'byte_order': self.border()}
+        self._q_data = ':FORM:DATA?'
+        self._w_data = ':FORM:DATA'
+        self._q_border = ':FORM:BORD?'
+        self._w_border = ':FORM:BORD'
+        self.values = LazyValues(self._command, {
+                'data_format': self._q_data,
+                'byte_order': self._q_border})
+        # Accessors bound once per setting
+        self._get_data = self._command.make_getter(self._q_data)
+        self._set_data = self._command.make_setter(
+                self._q_data, self._w_data, self._validate.data,
+                self.values, 'data_format')
+        self._get_border = self._command.make_getter(self._q_border)
+        self._set_border = self._command.make_setter(
+                self._q_border, self._w_border, self._validate.border,
+                self.values, 'byte_order')
         self.data(char_val)
 
     # Specifies the output data format for Fetch, Read and Message command.
     def data(self, set_data=None):
-        query = ':FORM:DATA?'
-        write = ':FORM:DATA'
-        return self._command.read_write(
-            query, write, self._validate.data,
-            set_data, self.values, 'data_format')
+        if set_data is None:
+            return self._get_data()
+        return self._set_data(set_data)
 
     # Specifies byte order for non ASCII output formats.
     def border(self, set_border=None):
-        query = ':FORM:BORD?'
-        write = ':FORM:BORD'
-        return self._command.read_write(
-            query, write, self._validate.border,
-            set_border, self.values, 'byte_order')
+        if set_border is None:
+            return self._get_border()
+        return self._set_border(set_border)
 
 
 class Log:
@@ -300,13 +458,57 @@ class Log:
         self._validate = ValidateLog()
         self._channel = channel
         self._command = Command(self._bus)
-        self.values = {}
-        self.values = {
-                'sampling_on': self.get_pulse_state(),
-                'sample_channel': self.sample_channel(),
-                'sample_type': self.sample_type(),
-                'sample_interval': self.sample_interval(),
-                'sample_length': self.sample_length()}
+        ch = self._channel
+        self._q_sample_length = f':SENS:{ch}:PULS:SAMP:LENG?'
+        self._w_sample_length = f':SENS:{ch}:PULS:SAMP:LENG'
+        self._q_sample_channel = f':SENS:{ch}:PULS:MEAS:CHAN?'
+        self._w_sample_channel = f':SENS:{ch}:PULS:MEAS:CHAN'
+        self._q_sample_type = f':SENS:{ch}:PULS:MEAS:TYPE?'
+        self._w_sample_type = f':SENS:{ch}:PULS:MEAS:TYPE'
+        self._q_sample_interval = f':SENS:{ch}:PULS:SAMP:INT?'
+        self._w_sample_interval = f':SENS:{ch}:PULS:SAMP:INT'
+        self._q_pulse_state = f':SENS:{ch}:PULS:MEAS:STAR?'
+        self._q_array = f':FETC:{ch}:ARR?'
+        # Measurement event bits:
+        # pulse trigger timeout; reading available; measurement overflow
+        if self._channel == 'A':
+            self._event_mask = 56
+            self._reading_avail = 32
+            self._trigger_timeout = 16
+            self._meas_overflow = 8
+            self._pulse_start = '*AARM'
+        else:
+            self._event_mask = 448
+            self._reading_avail = 256
+            self._trigger_timeout = 128
+            self._meas_overflow = 64
+            self._pulse_start = '*BARM'
+        self.values = LazyValues(self._command, {
+                'sampling_on': self._q_pulse_state,
+                'sample_channel': self._q_sample_channel,
+                'sample_type': self._q_sample_type,
+                'sample_interval': self._q_sample_interval,
+                'sample_length': self._q_sample_length})
+        # Accessors bound once per setting
+        self._get_sample_length = self._command.make_getter(
+                self._q_sample_length)
+        self._set_sample_length = self._command.make_setter(
+                self._q_sample_length, self._w_sample_length,
+                self._validate.sample_length, self.values, 'sample_length')
+        self._get_sample_channel = self._command.make_getter(
+                self._q_sample_channel)
+        self._set_sample_channel = self._command.make_setter(
+                self._q_sample_channel, self._w_sample_channel,
+                self._validate.sample_channel, self.values, 'sample_channel')
+        self._get_sample_type = self._command.make_getter(self._q_sample_type)
+        self._set_sample_type = self._command.make_setter(
+                self._q_sample_type, self._w_sample_type,
+                self._validate.sample_type, self.values, 'sample_type')
+        self._get_sample_interval = self._command.make_getter(
+                self._q_sample_interval)
+        self._set_sample_interval = self._command.make_setter(
+                self._q_sample_interval, self._w_sample_interval,
+                self._validate.sample_interval, self.values, 'sample_interval')
         self.log_data = {}
 
         # PulseAnalysis class shortcuts
@@ -314,59 +516,93 @@ class Log:
         self.status = Status(self._bus)
 
     def sample_length(self, set_sample_length=None):
-        query = ':SENS:' + self._channel + ':PULS:SAMP:LENG?'
-        write = ':SENS:' + self._channel + ':PULS:SAMP:LENG'
-        return self._command.read_write(
-                query, write, self._validate.sample_length,
-                set_sample_length, self.values, 'sample_length')
+        if set_sample_length is None:
+            return self._get_sample_length()
+        return self._set_sample_length(set_sample_length)
 
     def sample_channel(self, set_sample_channel=None):
-        query = ':SENS:' + self._channel + ':PULS:MEAS:CHAN?'
-        write = ':SENS:' + self._channel + ':PULS:MEAS:CHAN'
-        return self._command.read_write(
-                query, write, self._validate.sample_channel,
-                set_sample_channel, self.values, 'sample_source')
+        if set_sample_channel is None:
+            return self._get_sample_channel()
+        return self._set_sample_channel(set_sample_channel)
 
     def sample_type(self, set_sample_type=None):
-        query = ':SENS:' + self._channel + ':PULS:MEAS:TYPE?'
-        write = ':SENS:' + self._channel + ':PULS:MEAS:TYPE'
-        return self._command.read_write(
-                query, write, self._validate.sample_type,
-                set_sample_type, self.values, 'sample_type')
+        if set_sample_type is None:
+            return self._get_sample_type()
+        return self._set_sample_type(set_sample_type)
 
     def sample_interval(self, set_sample_interval=None):
-        query = ':SENS:' + self._channel + ':PULS:SAMP:INT?'
-        write = ':SENS:' + self._channel + ':PULS:SAMP:INT'
-        return self._command.read_write(
-                query, write, self._validate.sample_interval,
-                set_sample_interval, self.values, 'sample_interval')
+        if set_sample_interval is None:
+            return self._get_sample_interval()
+        return self._set_sample_interval(set_sample_interval)
 
     def get_pulse_state(self):
-        query = ':SENS:' + self._channel + ':PULS:MEAS:STAR?'
-        return self._command.read(query)
-
-    def start_sample(self):
+        return self._command.read(self._q_pulse_state)
+
+    # timeout (ms) defaults to twice the sampling time, at least 10 s
+    def start_sample(self, binary=True, timeout=None):
+        if timeout is None:
+            timeout = self._sample_timeout()
+        enable_reg = self._prepare_sample()
+        try:
+            self._arm_sample()
+            # Wait for SRQ
+            self._bus.wait_for_srq(timeout)
+            self._read_sample(binary)
+        finally:
+            self._disarm_sample(enable_reg)
+
+    # Same as start_sample, but the SRQ is delivered by a VISA event
+    # handler so the event loop keeps running while the pulse is sampled.
+    async def start_sample_async(self, binary=True, timeout=None):
+        if timeout is None:
+            timeout = self._sample_timeout()
+        loop = asyncio.get_running_loop()
+        srq = asyncio.Event()
+
+        def on_srq(resource, event, user_handle):
+            loop.call_soon_threadsafe(srq.set)
+
+        event_type = pyvisa.constants.EventType.service_request
+        mechanism = pyvisa.constants.EventMechanism.handler
+        enable_reg = self._prepare_sample()
+        try:
+            handler = self._bus.wrap_handler(on_srq)
+            user_handle = self._bus.install_handler(event_type, handler)
+            enabled = False
+            try:
+                self._bus.enable_event(event_type, mechanism)
+                enabled = True
+                self._arm_sample()
+                await asyncio.wait_for(srq.wait(), timeout / 1000)
+            finally:
+                if enabled:
+                    self._bus.disable_event(event_type, mechanism)
+                self._bus.uninstall_handler(event_type, handler, user_handle)
+            self._read_sample(binary)
+        finally:
+            self._disarm_sample(enable_reg)
+
+    def _sample_timeout(self):
+        sampling_time = (float(self.values['sample_interval'])
+                         * int(self.values['sample_length']))
+        return max(10000, int(2000 * sampling_time))
+
+    # Clear old data, errors and events. Returns the measurement enable
+    # register to restore with _disarm_sample.
+    def _prepare_sample(self):
         self.log_data.clear()
         # Clear the error queue
         self.status.clear_error_queue()
         # Clear measurement event register
         self.status.get_meas_event_reg()
         # Save current measurement enable register
-        enable_reg = int(self.status.meas_enable_reg())
-        # Enable measurement events:
-        # pulse trigger timeout; reading available; measurement overflow
-        if self._channel == 'A':
-            self.status.meas_enable_reg(56)
-            reading_avail = 32
-            trigger_timeout = 16
-            meas_overflow = 8
-            pulse_start = '*AARM'
-        else:
-            self.status.meas_enable_reg(448)
-            reading_avail = 256
-            trigger_timeout = 128
-            meas_overflow = 64
-            pulse_start = '*BARM'
+        return int(self.status.meas_enable_reg())
+
+    # Enable the channel's measurement events and SRQ, then arm the pulse
+    # measurement.
+    def _arm_sample(self):
+        # Enable measurement events
+        self.status.meas_enable_reg(self._event_mask)
         sre_status_bit = 1
 
         # Enable service request for measurement bit (MSB)
@@ -374,34 +610,72 @@ class Log:
 
         # Enable pulse measurement
         self.com.wait()
-        write = pulse_start
+        write = self._pulse_start
         self._command.write(write)
+        self._command.flush()
 
-        # Wait for SRQ
-        self._bus.wait_for_srq(10000)
-        self.com.sre(0)
-
+    def _read_sample(self, binary=True):
         # Get measurement event register
         event_reg = int(self.status.get_meas_event_reg())
-        if event_reg & reading_avail:
-            data = self._bus.query(':FETC:' + self._channel + ':ARR?')
-            if self.values['sample_channel'] in ['CURR', 'CURRENT']:
-                self.log_data['current'] = np.array(data.split(';'), dtype='f')
+        self._store_sample(event_reg, binary)
+
+    # Disable SRQ and restore the measurement enable register, also when
+    # the wait or fetch failed
+    def _disarm_sample(self, enable_reg):
+        self.com.sre(0)
+        self.status.meas_enable_reg(enable_reg)
+
+    # Fetch the sample into log_data, or report why there is none
+    def _store_sample(self, event_reg, binary=True):
+        if event_reg & self._reading_avail:
+            data = self.fetch_array(binary)
+            sample_channel = self.values['sample_channel'].strip().upper()
+            if sample_channel in _CURR_SAMPLE:
+                self.log_data['current'] = data
             else:
-                self.log_data['voltage'] = np.array(data.split(';'), dtype='f')
-            self.log_data['seconds'] = np.arange(
-                    0,
-                    float(self.values['sample_interval'])
-                    * int(self.values['sample_length']),
-                    float(self.values['sample_interval']))
-        elif event_reg & trigger_timeout:
-            print('Trigger timeout channel: ' + self._channel)
+                self.log_data['voltage'] = data
+            interval = float(self.values['sample_interval'])
+            length = int(self.values['sample_length'])
+            self.log_data['seconds'] = (
+                    np.arange(length, dtype=np.float32) * interval)
+        elif event_reg & self._trigger_timeout:
+            print(f'Trigger timeout channel: {self._channel}')
         else:
-            print('Unknown error, event: ' + str(event_reg))
-        if event_reg & meas_overflow:
-            print('Warning: measurement range overflow on channel: ' + self._channel)
-        # Restore measurement enable register
-        self.status.meas_enable_reg(enable_reg)
+            print(f'Unknown error, event: {event_reg}')
+        if event_reg & self._meas_overflow:
+            print('Warning: measurement range overflow on channel: '
+                  f'{self._channel}')
+
+    # Fetch the sample array as an IEEE 488.2 binary block of little endian
+    # single precision floats, then restore the previous data format.
+    # With binary=False the ASCII reply of the current format is parsed.
+    # The VISA chunk size is raised to the expected reply size (up to 16
+    # ASCII characters per sample) so the array arrives in one read.
+    def fetch_array(self, binary=True):
+        chunk_size = self._bus.chunk_size
+        self._bus.chunk_size = max(
+                chunk_size, int(self.values['sample_length']) * 16)
+        try:
+            if not binary:
+                data = self._command.read(self._q_array)
+                return np.fromstring(data, dtype=np.float32, sep=';')
+            return self._fetch_binary_array()
+        finally:
+            self._bus.chunk_size = chunk_size
+
+    def _fetch_binary_array(self):
+        data_format, byte_order = self._command.query_many(
+                [':FORM:DATA?', ':FORM:BORD?'])
+        self._command.write(':FORM:DATA SRE;:FORM:BORD SWAP')
+        self._command.flush()
+        try:
+            data = self._bus.query_binary_values(
+                    self._q_array, datatype='f',
+                    is_big_endian=False, container=np.ndarray)
+        finally:
+            self._command.write(
+                    f':FORM:DATA {data_format};:FORM:BORD {byte_order}')
+        return np.array(data, dtype='f')
 
 
 class Measure:
@@ -409,23 +683,38 @@ class Measure:
         self._bus = bus
         self._channel = channel
         self._command = Command(self._bus)
+        ch = self._channel
+        self._q_sense = f':SENS:{ch}:FUNC?'
+        self._w_sense = f':SENS:{ch}:FUNC'
+        self._q_voltage = f':MEAS:{ch}:VOLT?'
+        self._q_current = f':MEAS:{ch}:CURR?'
+        self._q_power = f'{self._q_voltage};{self._q_current}'
+        self._q_stat = {}
         self._validate = ValidateChannel()
-        self.values = {}
-        self.values = {'sense': self.sense()}
+        self.values = LazyValues(self._command, {'sense': self._q_sense})
+        # Accessors bound once per setting
+        self._get_sense = self._command.make_getter(self._q_sense)
+        self._set_sense = self._command.make_setter(
+                self._q_sense, self._w_sense, self._validate.sense,
+                self.values, 'sense')
         # self._sense = Channel.sense
 
     # Selects Fetch, Read, Measure function type
     def sense(self, set_sense=None):
-        query = ':SENS:' + self._channel + ':FUNC?'
-        write = ':SENS:' + self._channel + ':FUNC'
-        return self._command.read_write(
-                query, write, self._validate.sense,
-                set_sense, self.values, 'sense')
+        if set_sense is None:
+            return self._get_sense()
+        return self._set_sense(set_sense)
 
     def __get_stat(self, meas_source: str, stat_type: str):
-        if meas_source not in self.values['sense']:
+        # values follows refresh() and keyword writes, so the sense function
+        # is switched again whenever the instrument may have changed it
+        if self.values['sense'] != meas_source:
             self.sense(meas_source)
-        query = ':MEAS:' + self._channel + ':' + stat_type + '?'
+            self.values['sense'] = meas_source
+        query = self._q_stat.get(stat_type)
+        if query is None:
+            query = self._q_stat[stat_type] = (
+                    f':MEAS:{self._channel}:{stat_type}?')
         return self._command.read(query)
 
     # ###############################
@@ -433,17 +722,15 @@ class Measure:
     # ###############################
 
     def voltage(self):
-        query = ':MEAS:' + self._channel + ':VOLT?'
-        return self._command.read(query)
+        return self._command.read(self._q_voltage)
 
     def current(self):
-        query = ':MEAS:' + self._channel + ':CURR?'
-        return self._command.read(query)
+        return self._command.read(self._q_current)
 
+    # Voltage and current are read in one compound query
     def power(self):
-        volts = np.single(self.voltage())
-        curr = np.single(self.current())
-        return str(volts * curr)
+        volts, curr = self._command.read(self._q_power).split(';')
+        return str(float(volts) * float(curr))
 
     def current_low(self):
         return self.__get_stat('CURR', 'LOW')
@@ -536,32 +823,41 @@ class Measure:
 class RelayControl:
     def __init__(self, bus):
         self._bus = bus
+        self._command = Command(self._bus)
+        # All relay states in one compound query
+        states = self._command.query_many(
+                [':OUTP:REL1?', ':OUTP:REL2?', ':OUTP:REL3?', ':OUTP:REL4?'])
 
         # RelayControl class shortcuts
-        self.r1 = Relay(self._bus, 1)
-        self.r2 = Relay(self._bus, 2)
-        self.r3 = Relay(self._bus, 3)
-        self.r4 = Relay(self._bus, 4)
+        self.r1 = Relay(self._bus, 1, states[0])
+        self.r2 = Relay(self._bus, 2, states[1])
+        self.r3 = Relay(self._bus, 3, states[2])
+        self.r4 = Relay(self._bus, 4, states[3])
 
 
 class Relay:
-    def __init__(self, bus, num=1):
+    # initial_state skips the state query when it is already known
+    def __init__(self, bus, num=1, initial_state=None):
         self._bus = bus
         self._command = Command(self._bus)
         self._validate = ValidateRelay()
         num_validated = self._validate.relay_number(num)
-        if isinstance(num_validated, (ValueError, TypeError)):
-            raise num_validated
-        self.values = {}
+        self._q_state = f':OUTP:REL{num_validated}?'
+        self._w_state = f':OUTP:REL{num_validated}'
+        self.values = LazyValues(self._command, {'state': self._q_state})
         self.values['relay'] = num_validated
-        self.values['state'] = self.enable()
+        if initial_state is not None:
+            self.values['state'] = initial_state
+        # Accessors bound once per setting
+        self._get_state = self._command.make_getter(self._q_state)
+        self._set_state = self._command.make_setter(
+                self._q_state, self._w_state, self._validate.on_off,
+                self.values, 'state')
 
     def enable(self, set_relay_on_off=None):
-        query = ':OUTP:REL' + str(self.values['relay']) + '?'
-        write = ':OUTP:REL' + str(self.values['relay'])
-        return self._command.read_write(
-                query, write, self._validate.on_off,
-                set_relay_on_off, self.values, 'state')
+        if set_relay_on_off is None:
+            return self._get_state()
+        return self._set_state(set_relay_on_off)
 
     def on(self):
         self.enable('ON')
@@ -575,6 +871,22 @@ class Status:
         self._bus = bus
         self._validate = ValidateRegister()
         self._command = Command(self._bus)
+        # Accessors bound once per setting
+        self._get_meas_enable_reg = self._command.make_getter(
+                ':STAT:MEAS:ENAB?')
+        self._set_meas_enable_reg = self._command.make_setter(
+                ':STAT:MEAS:ENAB?', ':STAT:MEAS:ENAB',
+                self._validate.register_16)
+        self._get_opr_enable_reg = self._command.make_getter(
+                ':STAT:OPER:ENAB?')
+        self._set_opr_enable_reg = self._command.make_setter(
+                ':STAT:OPER:ENAB?', ':STAT:OPER:ENAB',
+                self._validate.register_16)
+        self._get_ques_enable_reg = self._command.make_getter(
+                ':STAT:QUES:ENAB?')
+        self._set_ques_enable_reg = self._command.make_setter(
+                ':STAT:QUES:ENAB?', ':STAT:QUES:ENAB',
+                self._validate.register_16)
         # Status class shortcuts
         self.com = Common(self._bus)
 
@@ -587,10 +899,9 @@ class Status:
         return self._command.read(query)
 
     def meas_enable_reg(self, reg_value=None):
-        query = ':STAT:MEAS:ENAB?'
-        write = ':STAT:MEAS:ENAB'
-        return self._command.read_write(
-                query, write, self._validate.register_16, reg_value)
+        if reg_value is None:
+            return self._get_meas_enable_reg()
+        return self._set_meas_enable_reg(reg_value)
 
     def get_opr_event_reg(self):
         query = ':STAT:OPER:EVEN?'
@@ -601,10 +912,9 @@ class Status:
         return self._command.read(query)
 
     def opr_enable_reg(self, reg_value=None):
-        query = ':STAT:OPER:ENAB?'
-        write = ':STAT:OPER:ENAB'
-        return self._command.read_write(
-                query, write, self._validate.register_16, reg_value)
+        if reg_value is None:
+            return self._get_opr_enable_reg()
+        return self._set_opr_enable_reg(reg_value)
 
     def get_ques_event_reg(self):
         query = ':STAT:QUES:EVEN?'
@@ -615,10 +925,9 @@ class Status:
         return self._command.read(query)
 
     def ques_enable_reg(self, reg_value=None):
-        query = ':STAT:QUES:ENAB?'
-        write = ':STAT:QUES:ENAB'
-        return self._command.read_write(
-                query, write, self._validate.register_16, reg_value)
+        if reg_value is None:
+            return self._get_ques_enable_reg()
+        return self._set_ques_enable_reg(reg_value)
 
     def reset_all_status_reg(self):
         write = ':STAT:PRES'
@@ -639,16 +948,65 @@ class Trigger:
         self._validate = ValidateTrigger()
         self._command = Command(self._bus)
         self._channel = channel
-        self.values = {}
-        self.values = {
-                'source': self.source(),
-                'level_low': self.level_low(),
-                'level_high': self.level_high(),
-                'level_dvm': self.level_dvm(),
-                'slope': self.slope(),
-                'count': self.count(),
-                'offset': self.offset(),
-                'timeout': self.timeout()}
+        ch = self._channel
+        self._q_source = f':SENS:{ch}:PULS:TRIG:SOUR?'
+        self._w_source = f':SENS:{ch}:PULS:TRIG:SOUR'
+        self._q_level_low = f':SENS:{ch}:PULS:TRIG:LEV:LOW?'
+        self._w_level_low = f':SENS:{ch}:PULS:TRIG:LEV:LOW'
+        self._q_level_high = f':SENS:{ch}:PULS:TRIG:LEV:HIGH?'
+        self._w_level_high = f':SENS:{ch}:PULS:TRIG:LEV:HIGH'
+        self._q_level_dvm = f':SENS:{ch}:PULS:TRIG:LEV:DVM?'
+        self._w_level_dvm = f':SENS:{ch}:PULS:TRIG:LEV:DVM'
+        self._q_count = f':SENS:{ch}:PULS:TRIG:COUN?'
+        self._w_count = f':SENS:{ch}:PULS:TRIG:COUN'
+        self._q_slope = f':SENS:{ch}:PULS:TRIG:SLOP?'
+        self._w_slope = f':SENS:{ch}:PULS:TRIG:SLOP'
+        self._q_offset = f':SENS:{ch}:PULS:TRIG:OFFS?'
+        self._w_offset = f':SENS:{ch}:PULS:TRIG:OFFS'
+        self._q_timeout = f':SENS:{ch}:PULS:TRIG:TIM?'
+        self._w_timeout = f':SENS:{ch}:PULS:TRIG:TIM'
+        self.values = LazyValues(self._command, {
+                'source': self._q_source,
+                'level_low': self._q_level_low,
+                'level_high': self._q_level_high,
+                'level_dvm': self._q_level_dvm,
+                'slope': self._q_slope,
+                'count': self._q_count,
+                'offset': self._q_offset,
+                'timeout': self._q_timeout})
+        # Accessors bound once per setting
+        self._get_source = self._command.make_getter(self._q_source)
+        self._set_source = self._command.make_setter(
+                self._q_source, self._w_source, self._validate.source,
+                self.values, 'source')
+        self._get_level_low = self._command.make_getter(self._q_level_low)
+        self._set_level_low = self._command.make_setter(
+                self._q_level_low, self._w_level_low, self._validate.level_low,
+                self.values, 'level_low')
+        self._get_level_high = self._command.make_getter(self._q_level_high)
+        self._set_level_high = self._command.make_setter(
+                self._q_level_high, self._w_level_high,
+                self._validate.level_high, self.values, 'level_high')
+        self._get_level_dvm = self._command.make_getter(self._q_level_dvm)
+        self._set_level_dvm = self._command.make_setter(
+                self._q_level_dvm, self._w_level_dvm, self._validate.level_dvm,
+                self.values, 'level_dvm')
+        self._get_count = self._command.make_getter(self._q_count)
+        self._set_count = self._command.make_setter(
+                self._q_count, self._w_count, self._validate.count,
+                self.values, 'count')
+        self._get_slope = self._command.make_getter(self._q_slope)
+        self._set_slope = self._command.make_setter(
+                self._q_slope, self._w_slope, self._validate.slope,
+                self.values, 'slope')
+        self._get_offset = self._command.make_getter(self._q_offset)
+        self._set_offset = self._command.make_setter(
+                self._q_offset, self._w_offset, self._validate.offset,
+                self.values, 'offset')
+        self._get_timeout = self._command.make_getter(self._q_timeout)
+        self._set_timeout = self._command.make_setter(
+                self._q_timeout, self._w_timeout, self._validate.timeout,
+                self.values, 'timeout')
 
     # #######################
     # NGMO trigger commands #
@@ -691,80 +1049,69 @@ class Trigger:
     # ############################
 
     def source(self, set_source=None):
-        query = ':SENS:' + self._channel + ':PULS:TRIG:SOUR?'
-        write = ':SENS:' + self._channel + ':PULS:TRIG:SOUR'
-        return self._command.read_write(
-                query, write, self._validate.source,
-                set_source, self.values, 'source')
+        if set_source is None:
+            return self._get_source()
+        return self._set_source(set_source)
 
     def level_low(self, set_level_low=None):
-        query = ':SENS:' + self._channel + ':PULS:TRIG:LEV:LOW?'
-        write = ':SENS:' + self._channel + ':PULS:TRIG:LEV:LOW'
-        return self._command.read_write(
-                query, write, self._validate.level_low,
-                set_level_low, self.values, 'level_low')
+        if set_level_low is None:
+            return self._get_level_low()
+        return self._set_level_low(set_level_low)
 
     def level_high(self, set_level_high=None):
-        query = ':SENS:' + self._channel + ':PULS:TRIG:LEV:HIGH?'
-        write = ':SENS:' + self._channel + ':PULS:TRIG:LEV:HIGH'
-        return self._command.read_write(
-                query, write, self._validate.level_high,
-                set_level_high, self.values, 'level_high')
+        if set_level_high is None:
+            return self._get_level_high()
+        return self._set_level_high(set_level_high)
 
     def level_dvm(self, set_level_dvm=None):
-        query = ':SENS:' + self._channel + ':PULS:TRIG:LEV:DVM?'
-        write = ':SENS:' + self._channel + ':PULS:TRIG:LEV:DVM'
-        return self._command.read_write(
-                query, write, self._validate.level_dvm,
-                set_level_dvm, self.values, 'level_dvm')
+        if set_level_dvm is None:
+            return self._get_level_dvm()
+        return self._set_level_dvm(set_level_dvm)
 
     def count(self, set_count=None):
-        query = ':SENS:' + self._channel + ':PULS:TRIG:COUN?'
-        write = ':SENS:' + self._channel + ':PULS:TRIG:COUN'
-        return self._command.read_write(
-                query, write, self._validate.count,
-                set_count, self.values, 'count')
+        if set_count is None:
+            return self._get_count()
+        return self._set_count(set_count)
 
     def slope(self, set_slope=None):
-        query = ':SENS:' + self._channel + ':PULS:TRIG:SLOP?'
-        write = ':SENS:' + self._channel + ':PULS:TRIG:SLOP'
-        return self._command.read_write(
-                query, write, self._validate.slope,
-                set_slope, self.values, 'slope')
+        if set_slope is None:
+            return self._get_slope()
+        return self._set_slope(set_slope)
 
     def offset(self, set_offset=None):
-        query = ':SENS:' + self._channel + ':PULS:TRIG:OFFS?'
-        write = ':SENS:' + self._channel + ':PULS:TRIG:OFFS'
-        return self._command.read_write(
-                query, write, self._validate.offset,
-                set_offset, self.values, 'offset')
+        if set_offset is None:
+            return self._get_offset()
+        return self._set_offset(set_offset)
 
     def timeout(self, set_timeout=None):
-        query = ':SENS:' + self._channel + ':PULS:TRIG:TIM?'
-        write = ':SENS:' + self._channel + ':PULS:TRIG:TIM'
-        return self._command.read_write(
-                query, write, self._validate.timeout,
-                set_timeout, self.values, 'timeout')
+        if set_timeout is None:
+            return self._get_timeout()
+        return self._set_timeout(set_timeout)
 
 
 # @TODO In progress
 class Protection:
     def __init__(self, bus, channel):
         self._bus = bus
+        self._command = Command(bus)
         self._channel = channel
+        ch = self._channel
+        self._w_open_on = f':OUTP:{ch}:OPEN:ON'
+        self._w_open_off = f':OUTP:{ch}:OPEN:OFF'
+        self._q_open = f':OUTP:{ch}:OPEN?'
 
     # ###############################
     # Channel protection functions #
     # ###############################
 
     def open_sense_protect_on(self):
-        self._bus.write(':OUTP:' + self._channel + ':OPEN:ON')
+        self._command.write(self._w_open_on)
 
     def open_sense_protect_off(self):
-        self._bus.write(':OUTP:' + self._channel + ':OPEN:OFF')
+        self._command.write(self._w_open_off)
 
     def get_open_sense_protect(self):
-        return self._bus.query(':OUTP:' + self._channel + ':OPEN?')
+        return self._command.read(self._q_open)
     pass
 
 
@@ -775,374 +1122,383 @@ class Config:
         pass
 
 
+_ANSI_ESC_SEQ = {'HEADER':    '\033[95m',
+                 'OKBLUE':    '\033[94m',
+                 'OKGREEN':   '\033[92m',
+                 'WARNING':   '\033[93m',
+                 'FAIL':      '\033[91m',
+                 'ENDC':      '\033[0m',
+                 'BOLD':      '\033[1m',
+                 'UNDERLINE': '\033[4m'
+                 }
+
+
+def _error_text(warning_type, error_type):
+    return (f'{_ANSI_ESC_SEQ[warning_type]}{error_type}'
+            f'{_ANSI_ESC_SEQ["ENDC"]}')
+
+
+_format_warning = functools.partial(_error_text, 'WARNING')
+
+
+def _in_range(value, limits):
+    return limits[0] <= value <= limits[1]
+
+
+def _in_set(value, values):
+    return value in values
+
+
+_PLAIN_TYPES = frozenset((int, float, str))
+
+
+# Lowercase form for the keyword sets and uppercase form to write, for the
+# few keywords a program keeps sending
+@functools.lru_cache(maxsize=256)
+def _keyword_forms(value):
+    val = value.lower()
+    return val, val.upper()
+
+
+# Keywords shared by the numeric settings
+_MINMAXDEF = frozenset(('min', 'max', 'def', 'default'))
+_AUTOMINMAXDEF = _MINMAXDEF | {'auto'}
+_INFMINMAXDEF = _MINMAXDEF | {'inf'}
+_ON_OFF = (0, 1), frozenset(('on', 'off'))
+
+
+# Fold bool and subclasses of float, int or str (e.g. numpy.float64) into
+# the builtin type, so the validators can match on type(value) alone
+def _plain(value):
+    if type(value) is bool:
+        return int(value)
+    for plain_type in (float, int, str):
+        if isinstance(value, plain_type):
+            return plain_type(value)
+    return value
+
+
 class Validate:
+    # Validators keep no per-instance state
+    __slots__ = ()
+
     def float_range(self):
-        return lambda x, y: y[0] <= x <= y[1]
+        return _in_range
 
     def int_range(self):
-        return lambda x, y: x in range(y[0], y[1] + 1)
+        return _in_range
 
     def find_element(self):
-        return lambda x, y: x in y
+        return _in_set
 
     def error_text(self, warning_type, error_type):
-        ansi_esc_seq = {'HEADER':    '\033[95m',
-                        'OKBLUE':    '\033[94m',
-                        'OKGREEN':   '\033[92m',
-                        'WARNING':   '\033[93m',
-                        'FAIL':      '\033[91m',
-                        'ENDC':      '\033[0m',
-                        'BOLD':      '\033[1m',
-                        'UNDERLINE': '\033[4m'
-                        }
-        return str(ansi_esc_seq[warning_type] + str(error_type) + ansi_esc_seq['ENDC'])
+        return _error_text(warning_type, error_type)
+
+    # Branches of the mixed numeric/keyword validators. num_text names the
+    # numeric part of validation_set in error messages.
+    def _rounded_range_branch(self, num_text, validation_set, value,
+                              round_to):
+        # Strictly within half a unit of the last kept decimal of the
+        # limits rounds into the range; only values right on that margin
+        # need round() to decide
+        half = 0.5 / 10 ** round_to
+        low, high = validation_set[0]
+        if (low - half < value < high + half
+                or low <= round(value, round_to) <= high):
+            return str(value)
+        raise self._num_error(num_text, validation_set)
+
+    def _range_branch(self, num_text, validation_set, value):
+        if _in_range(value, validation_set[0]):
+            return str(value)
+        raise self._num_error(num_text, validation_set)
+
+    def _set_branch(self, num_text, validation_set, value):
+        if float(value) in validation_set[0]:
+            return str(value)
+        raise self._num_error(num_text, validation_set)
+
+    def _str_branch(self, num_text, validation_set, value, *args):
+        val, keyword = _keyword_forms(value)
+        if val in validation_set[1]:
+            return keyword
+        raise ValueError('ValueError!\n'
+                         f'Not in set:(str) {sorted(validation_set[1])}\n'
+                         f'or in {num_text} {validation_set[0]}')
+
+    # Error messages are only built once a check has failed
+    def _num_error(self, num_text, validation_set):
+        return ValueError('ValueError!\n'
+                          f'Not in {num_text} {validation_set[0]}\n'
+                          f'or in set:(str) {sorted(validation_set[1])}')
+
+    def _type_error(self, value, valid_types):
+        return TypeError('TypeError!\n'
+                         f'Received type: {type(value)}\n'
+                         f'Valid types: {", ".join(map(str, valid_types))}')
+
+    # Branch per exact argument type (see _plain)
+    _FLOAT_RNG_AND_STR = {int: _rounded_range_branch,
+                          float: _rounded_range_branch,
+                          str: _str_branch}
+    _INT_RNG_AND_STR = {int: _range_branch, str: _str_branch}
+    _FLOAT_AND_STR = {int: _set_branch, float: _set_branch, str: _str_branch}
+    _INT_AND_STR = {int: _set_branch, str: _str_branch}
+
+    def _dispatch(self, branches, num_text, validation_set, value, *args):
+        if type(value) not in _PLAIN_TYPES:
+            value = _plain(value)
+        branch = branches.get(type(value))
+        if branch is None:
+            raise self._type_error(value, branches)
+        return branch(self, num_text, validation_set, value, *args)
 
     def float_rng_and_str_tuples(self, validation_set, value, round_to):
-        if isinstance(value, (float, int)):
-            val = round(float(value), round_to)
-            validator = self.float_range()
-            if validator(val, validation_set[0]):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in range:(float, int) {}\n'
-                                  'or in set:(str) {}'.format(
-                                   validation_set[0],
-                                   validation_set[1]))
-        elif isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set[1]).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}\n'
-                                  'or in range:(float, int) {}'.format(
-                                   validation_set[1],
-                                   validation_set[0]))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}, {}'.format(
-                              type(value), int, float, str))
+        return self._dispatch(self._FLOAT_RNG_AND_STR, 'range:(float, int)',
+                              validation_set, value, round_to)
 
     def int_rng_and_str_tuples(self, validation_set, value):
-        if isinstance(value, int):
-            val = value
-            validator = self.int_range()
-            if validator(val, validation_set[0]):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in range:(int) {}\n'
-                                  'or in set:(str) {}'.format(
-                                   validation_set[0],
-                                   validation_set[1]))
-        elif isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set[1]).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}\n'
-                                  'or in range:(int) {}'.format(
-                                   validation_set[1],
-                                   validation_set[0]))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}'.format(
-                              type(value), int, str))
+        return self._dispatch(self._INT_RNG_AND_STR, 'range:(int)',
+                              validation_set, value)
 
     def float_and_str_tuples(self, validation_set, value):
-        if isinstance(value, (float, int)):
-            validator = self.find_element()
-            val = float(value)
-            if validator(val, validation_set[0]):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(float, int) {}\n'
-                                  'or in set:(str) {}'.format(
-                                   validation_set[0],
-                                   validation_set[1]))
-        elif isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set[1]).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}\n'
-                                  'or in set:(float, str) {}'.format(
-                                   validation_set[1],
-                                   validation_set[0]))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}, {}'.format(
-                              type(value), int, float, str))
+        return self._dispatch(self._FLOAT_AND_STR, 'set:(float, int)',
+                              validation_set, value)
 
     def int_and_str_tuples(self, validation_set, value):
-        if isinstance(value, int):
-            validator = self.find_element()
-            val = float(value)
-            if validator(val, validation_set[0]):
-                return str(value)
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(int) {}\n'
-                                  'or in set:(str) {}'.format(
-                                   validation_set[0],
-                                   validation_set[1]))
-        elif isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set[1]).lower()):
-                return val.upper()
-            else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}\n'
-                                  'or in set:(int) {}'.format(
-                                   validation_set[1],
-                                   validation_set[0]))
-        else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}, {}'.format(
-                              type(value), int, str))
+        return self._dispatch(self._INT_AND_STR, 'set:(int)',
+                              validation_set, value)
+
+    # Output, display and relay switches: 0, 1, False, True, 'ON' or 'OFF'.
+    # Anything else gets the int_and_str_tuples error.
+    def bool_or_onoff(self, value):
+        value_type = type(value)
+        if value_type is int or value_type is bool:
+            if value == 1:
+                return '1'
+            if value == 0:
+                return '0'
+        elif value_type is str:
+            val, keyword = _keyword_forms(value)
+            if val == 'on' or val == 'off':
+                return keyword
+        return self.int_and_str_tuples(_ON_OFF, value)
 
     def str_tuple(self, validation_set, value):
-        if isinstance(value, str):
-            val = value.lower()
-            validator = self.find_element()
-            if validator(val, str(validation_set).lower()):
-                return val.upper()
+        if type(value) not in _PLAIN_TYPES:
+            value = _plain(value)
+        value_type = type(value)
+        if value_type is str:
+            val, keyword = _keyword_forms(value)
+            if val in validation_set:
+                return keyword
             else:
-                return ValueError('ValueError!\n'
-                                  'Not in set:(str) {}'.format(
-                                   validation_set))
+                raise ValueError('ValueError!\n'
+                                 'Not in set:(str) '
+                                 f'{sorted(validation_set)}')
         else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}'.format(
-                              type(value), str))
+            raise self._type_error(value, (str,))
 
     def int_rng_tuple(self, validation_set, value):
-        if isinstance(value, int):
+        if type(value) not in _PLAIN_TYPES:
+            value = _plain(value)
+        value_type = type(value)
+        if value_type is int:
             val = value
-            validator = self.int_range()
-            if validator(val, validation_set):
+            if _in_range(val, validation_set):
                 return str(val)
             else:
-                return ValueError('ValueError!\n'
-                                  'Not in range:(int) {}'.format(
-                                   validation_set))
+                raise ValueError('ValueError!\n'
+                                 f'Not in range:(int) {validation_set}')
         else:
-            return TypeError('TypeError!\n'
-                             'Received type: {}\n'
-                             'Valid types: {}'.format(
-                              type(value), int))
+            raise self._type_error(value, (int,))
+
+
+# Validator method for a float_rng_and_str_tuples table with the widened
+# limits and keyword set bound in a closure. Only accepted int, float and
+# str values are handled inline; everything else, including all errors and
+# values right on the rounding margin, goes through the generic helper.
+# qualname names the method it becomes, e.g. 'ValidateChannel.voltage'.
+def _rounded_range_validator(qualname, validation_set, round_to):
+    half = 0.5 / 10 ** round_to
+    low = validation_set[0][0] - half
+    high = validation_set[0][1] + half
+    keywords = validation_set[1]
+
+    def validate(self, value):
+        value_type = type(value)
+        if value_type is float or value_type is int:
+            if low < value < high:
+                return str(value)
+        elif value_type is str:
+            val, keyword = _keyword_forms(value)
+            if val in keywords:
+                return keyword
+        return self.float_rng_and_str_tuples(validation_set, value, round_to)
+    validate.__qualname__ = qualname
+    validate.__name__ = qualname.rpartition('.')[2]
+    return validate
 
 
 class ValidateChannel(Validate):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+    _SENSE = frozenset(('volt', 'voltage', 'curr', 'current', 'dvm', 'dvmeter',
+                        'aver', 'average', 'peak', 'min', 'high', 'low',
+                        'rms'))
+    _OUTPUT_BANDWIDTH = _MINMAXDEF | {'high', 'low'}
+    _CHANNEL = frozenset(('a', 'b'))
+    _VOLTAGE = (0.0, 15.0), _MINMAXDEF
+    _CURRENT = (0.0, 5), _MINMAXDEF
+    _IMPEDANCE = (0.0, 1.0), _MINMAXDEF
+    _CURRENT_RANGE = (5.0, 0.5, 0.005), _MINMAXDEF | {
+            'auto', 'low', 'high', '5a', '0.5a', '0.005a'}
+    _MEASUREMENT_INTERVAL = (0.002, 0.2), _MINMAXDEF
+    _AVERAGE_COUNT = (1, 10), _MINMAXDEF
 
     def on_off(self, value):
-        on_off_values = (0, 1), ('ON', 'OFF')
-        return self.int_and_str_tuples(on_off_values, value)
+        return self.bool_or_onoff(value)
 
-    def voltage(self, value):
-        voltage_values = (0.0, 15.0), ('min', 'max', 'def', 'default')
-        return self.float_rng_and_str_tuples(voltage_values, value, 3)
+    voltage = _rounded_range_validator('ValidateChannel.voltage', _VOLTAGE, 3)
 
-    def current(self, value):
-        current_values = (0.0, 5), ('min', 'max', 'def', 'default')
-        return self.float_rng_and_str_tuples(current_values, value, 3)
+    current = _rounded_range_validator('ValidateChannel.current', _CURRENT, 3)
 
-    def impedance(self, value):
-        impedance_values = (0.0, 1.0), ('min', 'max', 'def', 'default')
-        return self.float_rng_and_str_tuples(impedance_values, value, 2)
+    impedance = _rounded_range_validator(
+            'ValidateChannel.impedance', _IMPEDANCE, 2)
 
     def sense(self, value):
-        sense_values = ('volt', 'voltage', 'curr',
-                        'current', 'dvm', 'dvmeter',
-                        'aver', 'average', 'peak',
-                        'min', 'high', 'low', 'rms'
-                        )
-
-        return self.str_tuple(sense_values, value)
+        return self.str_tuple(self._SENSE, value)
 
     def current_range(self, value):
-        current_range_values = (5.0, 0.5, 0.005), ('auto', 'low', 'high',
-                                                   'min', 'max', 'def',
-                                                   'default', '5a', '0.5a',
-                                                   '0.005a'
-                                                   )
-        return self.float_and_str_tuples(current_range_values, value)
+        return self.float_and_str_tuples(self._CURRENT_RANGE, value)
 
-    def measurement_interval(self, value):
-        meas_interval_values = (0.002, 0.2), ('max', 'min', 'def', 'default')
-        return self.float_rng_and_str_tuples(meas_interval_values, value, 3)
+    measurement_interval = _rounded_range_validator(
+            'ValidateChannel.measurement_interval', _MEASUREMENT_INTERVAL, 3)
 
     def average_count(self, value):
-        average_count_values = (1, 10), ('min', 'max', 'def', 'default')
-        return self.int_rng_and_str_tuples(average_count_values, value)
+        return self.int_rng_and_str_tuples(self._AVERAGE_COUNT, value)
 
     def output_bandwidth(self, value):
-        output_bandwidth_values = ('high', 'low', 'min',
-                                   'max', 'def', 'default'
-                                   )
-        return self.str_tuple(output_bandwidth_values, value)
+        return self.str_tuple(self._OUTPUT_BANDWIDTH, value)
 
     def channel(self, value):
-        channel_values = ('a', 'b')
-        return self.str_tuple(channel_values, value)
+        return self.str_tuple(self._CHANNEL, value)
 
 
 class ValidateDisplay(Validate):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+    _CHANNEL = _MINMAXDEF | {'a', 'b', 'dvma', 'dvmb'}
 
     def channel(self, value):
-        channel_values = ('a', 'b', 'dvma', 'dvmb', 'min', 'max', 'def', 'default')
-        return self.str_tuple(channel_values, value)
+        return self.str_tuple(self._CHANNEL, value)
 
     def on_off(self, value):
-        on_off_values = (0, 1), ('ON', 'OFF')
-        return self.int_and_str_tuples(on_off_values, value)
+        return self.bool_or_onoff(value)
 
 
 class ValidateFormat(Validate):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+    _DATA = frozenset(('ascii', 'asc', 'long', 'sre', 'sreal', 'dreal', 'dre',
+                       'min', 'max', 'def'))
+    _BORDER = _MINMAXDEF | {'normal', 'norm', 'swapped', 'swap'}
 
     def data(self, value):
-        data_values = ('ascii', 'asc', 'long',
-                       'sre', 'sreal', 'dreal',
-                       'dre', 'min', 'max', 'def'
-                       )
-        return self.str_tuple(data_values, value)
+        return self.str_tuple(self._DATA, value)
 
     def border(self, value):
-        border_values = ('normal', 'norm', 'swapped',
-                         'swap', 'min', 'max',
-                         'def', 'default'
-                         )
-        return self.str_tuple(border_values, value)
+        return self.str_tuple(self._BORDER, value)
 
 
 class ValidateLog(Validate):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+    _SAMPLE_CHANNEL = _MINMAXDEF | {'current', 'curr', 'dvm'}
+    _SAMPLE_TYPE = frozenset(('aver', 'average', 'peak', 'min', 'high', 'low',
+                              'rms'))
+    _SAMPLE_LENGTH = (1, 5000), _MINMAXDEF
+    _SAMPLE_INTERVAL = (0.00001, 1.0), _MINMAXDEF
 
     def sample_length(self, value):
-        sample_length_values = (1, 5000), ('min', 'max',
-                                           'def', 'default'
-                                           )
-        return self.int_rng_and_str_tuples(sample_length_values, value)
+        return self.int_rng_and_str_tuples(self._SAMPLE_LENGTH, value)
 
     def sample_channel(self, value):
-        sample_channel_values = ('current', 'curr', 'dvm',
-                                 'min', 'max', 'def', 'default'
-                                 )
-        return self.str_tuple(sample_channel_values, value)
+        return self.str_tuple(self._SAMPLE_CHANNEL, value)
 
     def sample_type(self, value):
-        sample_type_values = ('aver', 'average', 'peak',
-                              'min', 'high', 'low', 'rms'
-                              )
-        return self.str_tuple(sample_type_values, value)
+        return self.str_tuple(self._SAMPLE_TYPE, value)
 
-    def sample_interval(self, value):
-        sample_interval_values = (0.00001, 1.0), ('min', 'max', 'def', 'default')
-        return self.float_rng_and_str_tuples(sample_interval_values, value, 5)
+    sample_interval = _rounded_range_validator(
+            'ValidateLog.sample_interval', _SAMPLE_INTERVAL, 5)
 
 
 class ValidateRegister(Validate):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+    _REGISTER_8 = (0, 128)
+    _REGISTER_16 = (0, 65535)
+    _PRESET = (0, 9)
 
     def register_8(self, value):
-        register_values = (0, 128)
-        return self.int_rng_tuple(register_values, value)
+        return self.int_rng_tuple(self._REGISTER_8, value)
 
     def register_16(self, value):
-        register_values = (0, 65535)
-        return self.int_rng_tuple(register_values, value)
+        return self.int_rng_tuple(self._REGISTER_16, value)
 
     def preset(self, value):
-        preset_values = (0, 9)
-        return self.int_rng_tuple(preset_values, value)
+        return self.int_rng_tuple(self._PRESET, value)
 
 
 class ValidateRelay(Validate):
-    def __init__(self):
-        super().__init__()
+    __slots__ = ()
+    _RELAY_NUMBER = (1, 4)
 
     def relay_number(self, value):
-        relay_number_values = (1, 4)
-        return self.int_rng_tuple(relay_number_values, value)
+        return self.int_rng_tuple(self._RELAY_NUMBER, value)
 
     def on_off(self, value):
-        on_off_values = (0, 1), ('ON', 'OFF')
-        return self.int_and_str_tuples(on_off_values, value)
+        return self.bool_or_onoff(value)
 
 
 class ValidateTrigger(Validate):
-    def __init__(self):
-        super().__init__()
-
-    def source (self, value):
-        source_values = ('int', 'ext', 'min',
-                         'max', 'def', 'default'
-                         )
-        return self.str_tuple(source_values, value)
-
-    def level_low(self, value):
-        level_low_values = (0, 0.5), ('auto', 'min', 'max',
-                                      'def', 'default'
-                                      )
-        return self.float_rng_and_str_tuples(level_low_values, value, 3)
-
-    def level_high(self, value):
-        level_high_values = (0, 7.0), ('auto', 'min', 'max',
-                                       'def', 'default'
-                                       )
-        return self.float_rng_and_str_tuples(level_high_values, value, 3)
-
-    def level_dvm(self, value):
-        level_dvm_values = (-5.999, 25.0), ('auto', 'min', 'max',
-                                            'def', 'default'
-                                            )
-        return self.float_rng_and_str_tuples(level_dvm_values, value, 3)
+    __slots__ = ()
+    _SOURCE = _MINMAXDEF | {'int', 'ext'}
+    _SLOPE = _MINMAXDEF | {'pos', 'neg'}
+    _LEVEL_LOW = (0, 0.5), _AUTOMINMAXDEF
+    _LEVEL_HIGH = (0, 7.0), _AUTOMINMAXDEF
+    _LEVEL_DVM = (-5.999, 25.0), _AUTOMINMAXDEF
+    _COUNT = (1, 100), _MINMAXDEF
+    _OFFSET = (-5000, 50000), _MINMAXDEF
+    _TIMEOUT = (0.001, 60), _INFMINMAXDEF
+
+    def source(self, value):
+        return self.str_tuple(self._SOURCE, value)
+
+    level_low = _rounded_range_validator(
+            'ValidateTrigger.level_low', _LEVEL_LOW, 3)
+
+    level_high = _rounded_range_validator(
+            'ValidateTrigger.level_high', _LEVEL_HIGH, 3)
+
+    level_dvm = _rounded_range_validator(
+            'ValidateTrigger.level_dvm', _LEVEL_DVM, 3)
 
     def count(self, value):
-        count_values = (1, 100), ('min', 'max', 'def', 'default')
-        return self.int_rng_and_str_tuples(count_values, value)
+        return self.int_rng_and_str_tuples(self._COUNT, value)
 
     def slope(self, value):
-        slope_values = ('pos', 'neg', 'min',
-                        'max', 'def', 'default'
-                        )
-        return self.str_tuple(slope_values, value)
+        return self.str_tuple(self._SLOPE, value)
 
     def offset(self, value):
-        offset_values = (-5000, 50000), ('min', 'max', 'def', 'default')
-        return self.int_rng_and_str_tuples(offset_values, value)
+        return self.int_rng_and_str_tuples(self._OFFSET, value)
 
-    def timeout(self, value):
-        timeout_values = (0.001, 60), ('inf', 'min', 'max',
-                                       'def', 'default')
-        return self.float_rng_and_str_tuples(timeout_values, value, 3)
+    timeout = _rounded_range_validator('ValidateTrigger.timeout', _TIMEOUT, 3)
 
 
 class Command(Validate):
+    __slots__ = ('_bus', '_cache')
+    # Open write batches, one list per VISA session (see batched)
+    _batches = weakref.WeakKeyDictionary()
+
     def __init__(self, bus):
-        super().__init__()
         self._bus = bus
+        self._cache = QueryCache.for_bus(bus)
 
     def read_write_old(self, query: str, write: str,
                   validator=None, value=None,
@@ -1154,7 +1510,7 @@ class Command(Validate):
             if validator is not None:
                 val = validator
                 if isinstance(val, (ValueError, TypeError)):
-                    print(self.error_text('WARNING', val))
+                    print(_format_warning(val))
                 else:
                     self._bus.write(write)
                     if value_set is not None:
@@ -1167,39 +1523,231 @@ class Command(Validate):
                     value_set[value_key] = self._bus.query(query)
                 return None
 
+    # Reads the setting without a value, writes it with one. Callers that
+    # know which they need use query or set directly.
     def read_write(self, query: str, write: str,
                    validator=None, value=None,
                    value_dict=None, value_key=None):
         if value is None:
-            return self._bus.query(query)
+            return self.query(query)
         else:
-            if validator is not None:
-                val = validator(value)
-                if isinstance(val, (ValueError, TypeError)):
-                    print(self.error_text('WARNING', val))
-                else:
-                    write = write + ' ' + str(value)
-                    self._bus.write(write)
-                    if value_dict is not None:
-                        value_dict[value_key] = self._bus.query(query)
-                    return None
-
-            else:
-                write = write + ' ' + str(value)
-                self._bus.write(write)
-                if value_dict is not None:
-                    value_dict[value_key] = self._bus.query(query)
+            return self.set(
+                    query, write, validator, value, value_dict, value_key)
+
+    # Validated write of one setting. A number is stored in value_dict as
+    # written; a keyword (MAX, ON, ...) is resolved by the instrument, so
+    # it is dropped and read back on the next access instead.
+    def set(self, query: str, write: str, validator, value,
+            value_dict=None, value_key=None):
+        setting = value
+        if validator is not None:
+            try:
+                setting = validator(value)
+            except (ValueError, TypeError) as error:
+                print(_format_warning(error))
                 return None
-
+        write = f'{write} {setting}'
+        self._cache.pop(query)
+        self._send(write)
+        if value_dict is not None:
+            if isinstance(value, str):
+                value_dict.pop(value_key, None)
+            else:
+                value_dict[value_key] = str(setting)
+        return None
+
+    # Read one setting back from the instrument into value_dict
+    def refresh(self, value_dict, value_key, query: str):
+        self._cache.pop(query)
+        value_dict[value_key] = self.query(query)
+        return value_dict[value_key]
+
+    # Getter specialized for one setting query
+    def make_getter(self, query: str):
+        cached_query = self.query
+
+        def get_value():
+            return cached_query(query)
+        return get_value
+
+    # Setter with the query, write prefix and validator already bound
+    def make_setter(self, query: str, write: str, validator,
+                    value_dict=None, value_key=None):
+        set_setting = self.set
+
+        def set_value(value):
+            return set_setting(
+                    query, write, validator, value, value_dict, value_key)
+        return set_value
+
+    # Uncached query, used for measurements and event registers
     def read(self, query: str):
+        self.flush()
         return self._bus.query(query)
 
-    def write(self, write: str, validator=None):
-        if validator is None:
+    # Setting query, answered from the session cache while it is fresh
+    def query(self, query: str):
+        value = self._cache.get(query)
+        if value is None:
+            self.flush()
+            value = self._bus.query(query)
+            self._cache.put(query, value)
+        return value
+
+    # Sends all setting queries missing from the cache as one compound
+    # SCPI message and splits the semicolon separated reply
+    def query_many(self, queries):
+        values = [self._cache.get(query) for query in queries]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing:
+            self.flush()
+            reply = self._bus.query(';'.join(queries[i] for i in missing))
+            answers = reply.split(';')
+            if len(answers) != len(missing):
+                raise ValueError('Expected {} values, received: {}'.format(
+                                 len(missing), reply))
+            for i, value in zip(missing, answers):
+                values[i] = value
+                self._cache.put(queries[i], value)
+        return values
+
+    # Drop the given queries from the cache, or all of them
+    def invalidate_cache(self, queries=None):
+        if queries is None:
+            self._cache.clear()
+        else:
+            for query in queries:
+                self._cache.pop(query)
+
+    # Commands without a matching query may change any setting,
+    # so they drop the whole session cache
+    def write(self, write: str):
+        self._send(write)
+        self._cache.clear()
+
+    # Inside the with block the writes of every Command on this VISA
+    # session are collected and sent as one compound SCPI message when the
+    # block ends. Queries send the writes collected so far first.
+    @contextmanager
+    def batched(self):
+        if self._bus in self._batches:
+            yield self
+            return
+        self._batches[self._bus] = []
+        try:
+            yield self
+        finally:
+            # Close the batch before sending it, so a failed write does not
+            # leave it open for later commands
+            batch = self._batches.pop(self._bus)
+            if batch:
+                self._bus.write(';'.join(batch))
+
+    # Send the writes collected by batched, if any
+    def flush(self):
+        batch = self._batches.get(self._bus)
+        if batch:
+            self._bus.write(';'.join(batch))
+            batch.clear()
+
+    def _send(self, write: str):
+        batch = self._batches.get(self._bus)
+        if batch is None:
             self._bus.write(write)
         else:
-            val = validator
-            if isinstance(val, (ValueError, TypeError)):
-                print(self.error_text('WARNING', val))
-            else:
-                self._bus.write(write)
\ No newline at end of file
+            batch.append(write)
+
+
+# Setting query results shared by every Command on the same VISA session.
+# Entries expire after ttl seconds; a ttl of 0 disables caching.
+class QueryCache:
+    _sessions = weakref.WeakKeyDictionary()
+
+    def __init__(self, ttl=0.0):
+        self.ttl = ttl
+        self.enabled = True
+        self._values = {}
+
+    @classmethod
+    def for_bus(cls, bus):
+        cache = cls._sessions.get(bus)
+        if cache is None:
+            cache = cls._sessions[bus] = cls()
+        return cache
+
+    def get(self, query):
+        if not self.enabled or self.ttl <= 0:
+            return None
+        entry = self._values.get(query)
+        if entry is None:
+            return None
+        value, stamp = entry
+        if time.monotonic() - stamp > self.ttl:
+            del self._values[query]
+            return None
+        return value
+
+    def put(self, query, value):
+        if self.enabled and self.ttl > 0:
+            self._values[query] = (value, time.monotonic())
+
+    def pop(self, query):
+        self._values.pop(query, None)
+
+    def clear(self):
+        self._values.clear()
+
+
+# Values of a subsystem, read from the instrument on first access.
+# All query backed keys are fetched together in one compound query;
+# refresh() reads them again on the next access.
+class LazyValues(MutableMapping):
+    def __init__(self, command, queries):
+        self._command = command
+        self._queries = queries
+        self._values = {}
+        self._loaded = False
+
+    def _load(self):
+        if self._loaded:
+            return
+        keys = [key for key in self._queries if key not in self._values]
+        results = self._command.query_many(
+                [self._queries[key] for key in keys])
+        self._values.update(zip(keys, results))
+        self._loaded = True
+
+    # Drop one value without loading the rest; it is read again with the
+    # next load
+    def pop(self, key, *default):
+        self._loaded = False
+        return self._values.pop(key, *default)
+
+    def refresh(self):
+        for key in self._queries:
+            self._values.pop(key, None)
+        self._command.invalidate_cache(self._queries.values())
+        self._loaded = False
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            self._load()
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._values[key]
+
+    def __iter__(self):
+        self._load()
+        return iter(self._values)
+
+    def __len__(self):
+        self._load()
+        return len(self._values)
+
+    def __repr__(self):
+        self._load()
+        return repr(self._values)